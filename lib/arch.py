@@ -1,5 +1,7 @@
-import itertools, numpy, logging
+import csv, numpy, logging
+import scipy.sparse as sp
 import matplotlib.pyplot as plt
+from collections import defaultdict
 from dataclasses import dataclass
 from typing import Dict, List, Tuple
 
@@ -32,68 +34,108 @@ class ArchAnalyzer:
         code_deps: List[CodeDep] = CodeParser(fs_data).get_deps(compdb)
         # print(code_data.deps[0])
 
-        rule_matrix = numpy.ones((len(fs_data.index), len(fs_data.index)))
+        num_fs = len(fs_data.index)
 
+        # the rules mark the (src, dst) pairs that are allowed, so collect them
+        # as sparse COO triples instead of zeroing entries of a dense NxN matrix
+        allowed_srcs: List[int] = []
+        allowed_dsts: List[int] = []
+
+        desc_ptr = fs_data.desc_ptr
+        desc_idx = fs_data.desc_idx
         for rule in puml_data.rules:
-            # create list of descendent FileSystem IDs for src and dst
-            fs_src_ids: List[int] = []
-            fs_dst_ids: List[int] = []
-            fs_data.get_desc_ids(rule.src.fs_id, fs_src_ids)
-            fs_data.get_desc_ids(rule.dst.fs_id, fs_dst_ids)
-            # for all descendent src and dst IDs, create a rule
-            for src_id in fs_src_ids:
-                for dst_id in fs_dst_ids:
-                    rule_matrix[(src_id, dst_id)] = 0
+            # descendent FileSystem IDs for src and dst are precomputed slices
+            src_ids = desc_idx[desc_ptr[rule.src.fs_id] : desc_ptr[rule.src.fs_id + 1]]
+            dst_ids = desc_idx[desc_ptr[rule.dst.fs_id] : desc_ptr[rule.dst.fs_id + 1]]
+            # pair every descendent src ID with every descendent dst ID
+            allowed_srcs.extend(numpy.repeat(src_ids, len(dst_ids)))
+            allowed_dsts.extend(numpy.tile(dst_ids, len(src_ids)))
 
         for group in puml_data.fs_groups:
-            # for each permutation or combination of the filesystem groupings
-            for x, y in itertools.combinations(group, 2):
-                rule_matrix[(x, y)] = 0
-                rule_matrix[(y, x)] = 0
-
-        # print("ALL RULES")
-        # for rule in rule_matrix:
-        #     print(rule)
+            # allow every ordered off-diagonal pairing within the group
+            g = numpy.asarray(group, dtype=numpy.int32)
+            ii = numpy.repeat(g, len(g))
+            jj = numpy.tile(g, len(g))
+            off_diag = ii != jj
+            allowed_srcs.extend(ii[off_diag])
+            allowed_dsts.extend(jj[off_diag])
+
+        # pack each allowed (src, dst) pair into a single int64 key, the
+        # violation check is then one set probe per distinct dep pair
+        a_srcs = numpy.asarray(allowed_srcs, dtype=numpy.int64)
+        a_dsts = numpy.asarray(allowed_dsts, dtype=numpy.int64)
+        allowed_set = set(((a_srcs << 32) | a_dsts).tolist())
+
+        # pull the fs_ids into int32 arrays in one C-level pass
+        try:
+            dep_srcs = numpy.fromiter(
+                (dep.src.fs_id for dep in code_deps),
+                dtype=numpy.int32,
+                count=len(code_deps),
+            )
+            dep_dsts = numpy.fromiter(
+                (dep.dst.fs_id for dep in code_deps),
+                dtype=numpy.int32,
+                count=len(code_deps),
+            )
+        except TypeError:
+            print("ERROR: code dependency has Filsystem ID None")
+            exit(1)
 
-        dep_dict: Dict[Tuple[int, int], List[CodeDep]] = {}
-        dep_matrix = numpy.zeros((len(fs_data.index), len(fs_data.index)))
+        dep_dict: Dict[Tuple[int, int], List[CodeDep]] = defaultdict(list)
         for code_dep in code_deps:
-            if code_dep.src.fs_id == None or code_dep.dst.fs_id == None:
-                print(f"ERROR: code dependency has Filsystem ID None: {code_dep}")
-                exit(1)
-            dep_dict.setdefault((code_dep.src.fs_id, code_dep.dst.fs_id), []).append(
-                code_dep
-            )
-            dep_matrix[(code_dep.src.fs_id, code_dep.dst.fs_id)] += 1
+            dep_dict[(code_dep.src.fs_id, code_dep.dst.fs_id)].append(code_dep)
 
-        print("ALL DEPS")
-        # for dep in dep_matrix:
-        #     print(dep)
+        dep_matrix = sp.coo_matrix(
+            (numpy.ones_like(dep_srcs), (dep_srcs, dep_dsts)), shape=(num_fs, num_fs)
+        )
+        # collapse duplicate (src, dst) entries into per-pair counts
+        dep_matrix.sum_duplicates()
 
         print("VIOLATIONS")
-        violations_matrix = rule_matrix * dep_matrix
-        # for violation in violations_matrix:
-        #     print(violation)
-
-        violations = numpy.transpose(numpy.nonzero(violations_matrix))
+        # single fused pass over the dep nonzeros, a set probe per pair
+        # replaces the sparse mask multiply and its intermediate matrix
+        dep_keys = (dep_matrix.row.astype(numpy.int64) << 32) | dep_matrix.col
+        v_srcs: List[int] = []
+        v_dsts: List[int] = []
+        v_counts: List[int] = []
         code_dep_violations = []
-        for violation in violations:
-            code_dep_violations.extend(dep_dict[tuple(violation)])
+        for src_id, dst_id, count, key in zip(
+            dep_matrix.row, dep_matrix.col, dep_matrix.data, dep_keys.tolist()
+        ):
+            if key not in allowed_set:
+                v_srcs.append(src_id)
+                v_dsts.append(dst_id)
+                v_counts.append(count)
+                code_dep_violations.extend(dep_dict[(src_id, dst_id)])
 
         print(f"TOTAL VIOLATIONS = {len(code_dep_violations)}")
         # for dep in code_dep_violations:
         #     print(dep)
 
-        with open("reports/violations_report.csv", "w") as report:
-            for dep in code_dep_violations:
-                report.write(f"{dep.src.code_node.file},{dep.dst.code_node.file}\n")
+        # batch the report rows through csv.writer with a large buffer,
+        # one write per row means one syscall per row
+        with open(
+            "reports/violations_report.csv", "w", buffering=1 << 20, newline=""
+        ) as report:
+            csv.writer(report).writerows(
+                (dep.src.code_node.file, dep.dst.code_node.file)
+                for dep in code_dep_violations
+            )
 
-        with open("reports/file_index.csv", "w") as report:
-            for fs in fs_data.index.values():
-                report.write(f"{fs.id},{fs.full_path}\n")
+        with open(
+            "reports/file_index.csv", "w", buffering=1 << 20, newline=""
+        ) as report:
+            csv.writer(report).writerows(
+                (fs.id, fs.full_path) for fs in fs_data.index.values()
+            )
 
         fig, ax = plt.subplots()
-        im = ax.imshow(violations_matrix)
+        # only densify for rendering, the analysis itself stays sparse
+        violations_matrix = sp.coo_matrix(
+            (v_counts, (v_srcs, v_dsts)), shape=(num_fs, num_fs)
+        )
+        im = ax.imshow(violations_matrix.toarray())
 
         ax.xaxis.tick_top()
 
@@ -0,0 +1,43 @@
+import os
+from typing import Optional
+
+import xxhash
+import zstandard
+
+# cache entries live in ~/.cache/architector/{key[:2]}/{key}.pkl.zst
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "architector")
+
+
+def make_key(*parts: bytes) -> str:
+    """
+    Hashes the given byte strings into a cache key
+    """
+    digest = xxhash.xxh3_64()
+    for part in parts:
+        digest.update(part)
+    return digest.hexdigest()
+
+
+def _cache_path(key: str, subdir: str = "") -> str:
+    return os.path.join(CACHE_DIR, subdir, key[:2], f"{key}.pkl.zst")
+
+
+def get(key: str, subdir: str = "") -> Optional[bytes]:
+    """
+    Returns the decompressed value stored for key, or None on a miss
+    """
+    try:
+        with open(_cache_path(key, subdir), "rb") as blob:
+            return zstandard.decompress(blob.read())
+    except (FileNotFoundError, zstandard.ZstdError):
+        return None
+
+
+def put(key: str, value: bytes, subdir: str = ""):
+    """
+    Stores value under key, compressed with zstandard
+    """
+    path = _cache_path(key, subdir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as blob:
+        blob.write(zstandard.compress(value))
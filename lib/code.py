@@ -1,11 +1,14 @@
+import functools
 import logging
 import multiprocessing
 import os
+import pickle
 import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass, field
-from typing import Dict, List, TextIO
+from typing import Dict, List, TextIO, Tuple
 
-from joblib import Parallel, delayed
 from clang.cindex import Index
 from clang.cindex import CompileCommand
 from clang.cindex import CompilationDatabase
@@ -14,18 +17,68 @@ from clang.cindex import Cursor
 from clang.cindex import CursorKind
 from clang.cindex import TranslationUnit
 
+from . import cache
 from .fs import FSData
 from .logging import log_with
 from .util import UniqueDict
 
 logger = logging.getLogger(__name__)
 
+# cursor kinds we care about:
+# CursorKind.INCLUSION_DIRECTIVE,
+# CursorKind.TYPE_REF..CursorKind.VARIABLE_REF,
+# CursorKind.DECL_REF_EXPR..CursorKind.CALL_EXPR
+# stored as a 1024-bit lookup table indexed by kind value, which is
+# cheaper per test than a frozenset probe or chained comparisons
+def _build_kind_mask(kinds) -> bytes:
+    mask = bytearray(128)
+    for kind in kinds:
+        mask[kind >> 3] |= 1 << (kind & 7)
+    return bytes(mask)
+
+
+_KIND_MASK = _build_kind_mask((503, *range(40, 51), *range(101, 104)))
+
+# extra args appended to every compile command, shared as one immutable
+# tuple instead of re-building a list copy per command
+CUSTOM_ARGS = (
+    "-ferror-limit=0",
+    "-isystem",
+    "/Library/Developer/CommandLineTools/usr/lib/clang/11.0.0/include",
+    "-isystem",
+    "/Library/Developer/CommandLineTools/usr/include/c++/v1",
+    "-isystem",
+    "/Library/Developer/CommandLineTools/SDKs/MacOSX10.15.sdk/usr/include",
+    "-isystem",
+    "/opt/llvm/lib/clang/9.0.1/include",
+)
+
+
+# shared copies of canonicalized paths, a heavily-included header shows up
+# in millions of CodeNodes and each deserves one str object, not millions
+_PATH_INTERN: Dict[str, str] = {}
+
+
+def _intern_path(path: str) -> str:
+    return _PATH_INTERN.setdefault(path, path)
+
+
+@functools.lru_cache(maxsize=None)
+def _realpath(path: str) -> str:
+    # the same header is referenced thousands of times per TU, cache the
+    # canonicalization so we do not stat through the VFS layer every time
+    return os.path.realpath(path)
+
 
 class CodeNode:
+    # instantiated per relevant cursor, potentially millions of times,
+    # so drop the per-instance __dict__
+    __slots__ = ("id", "file", "start_line", "end_line", "start_col", "end_col", "kind")
+
     def __init__(self, cursor: Cursor):
         # self.id = str(cursor.get_usr())
         self.id = cursor.hash
-        self.file = os.path.realpath(str(cursor.location.file))
+        self.file = _intern_path(_realpath(str(cursor.location.file)))
         self.start_line = cursor.extent.start.line
         self.end_line = cursor.extent.end.line
         self.start_col = cursor.extent.start.column
@@ -43,12 +96,16 @@ class CodeNode:
 
 @dataclass
 class CodeRef:
+    __slots__ = ("fs_id", "code_node")
+
     fs_id: int
     code_node: CodeNode
 
 
 @dataclass
 class CodeDep:
+    __slots__ = ("src", "dst")
+
     src: CodeRef
     dst: CodeRef
 
@@ -61,7 +118,7 @@ class CompCmd:
   """
 
     filename: str
-    cmd: List[str]
+    cmd: Tuple[str, ...]
 
 
 class TUParser:
@@ -74,27 +131,15 @@ class TUParser:
         return cursor.location.is_in_system_header()
 
     def _cursor_kind_filter(self, cursor_kind: int):
-        return (
-            503 == cursor_kind or 40 <= cursor_kind <= 50 or 101 <= cursor_kind <= 103
-        )
-        # CursorKind.INCLUSION_DIRECTIVE.value == cursor_kind or \
-        # CursorKind.TYPE_REF.value <= cursor_kind <= CursorKind.VARIABLE_REF.value or \
-        # CursorKind.DECL_REF_EXPR.value <= cursor_kind <= CursorKind.CALL_EXPR.value
-
-    def _cursor_filter(self, cursor: Cursor):
-        # this is not very omptimized but avoids processing lots of stuff...
-        # ignore system header references
-        # ignore if reference in the same file
-        return (
-            cursor.referenced
-            and not cursor.referenced.location.is_in_system_header()
-            and cursor.referenced.location.file
-            and cursor.location.file.name != cursor.referenced.location.file.name
+        return cursor_kind < 1024 and bool(
+            _KIND_MASK[cursor_kind >> 3] & (1 << (cursor_kind & 7))
         )
 
     def _get_cursor_fs_id(self, node_path: str) -> int:
         # fs_id = next((fs.id for fs in self.fs_data.index.values() if os.path.samefile(node_path, fs.full_path)), None)
-        fs = self.fs_data.file_index.get(os.path.abspath(node_path), None)
+        # file_index keys are already canonicalized by FSScanner, so a cached
+        # realpath of the node path is enough to hit the dict directly
+        fs = self.fs_data.file_index.get(_realpath(node_path), None)
         # if fs_id is None:
         #     raise Exception(f"Unable to get FileSystem ID from node_path {node_path}")
         if fs:
@@ -136,34 +181,56 @@ class TUParser:
             )
         )
 
-    def _handle_cursor(self, cursor: Cursor):
-        try:
-            # ignore all cursors in system headers
-            if self._cursor_skip(cursor):
-                return
-            for child in cursor.get_children():
-                self._handle_cursor(child)
-            if self._cursor_kind_filter(int(cursor.kind.value)):
-                if cursor.kind == CursorKind.INCLUSION_DIRECTIVE:
-                    if cursor.get_included_file():
-                        self._create_code_dep(
-                            cursor, dst_file=cursor.get_included_file().name
-                        )
+    def _handle_cursor(self, root_cursor: Cursor):
+        # iterative traversal with an explicit stack, recursing per cursor
+        # spends most of the time in Python call overhead
+        stack = deque((root_cursor,))
+        while stack:
+            cursor = stack.pop()
+            # the try/except isolates one cursor, expected AssertionErrors
+            # (e.g. kind values missing from the bindings) are routine and
+            # must not discard the cursors still queued
+            try:
+                # every attribute on a Cursor crosses the Python->libclang
+                # boundary, so read each one once into a local
+                location = cursor.location
+                # ignore all cursors in system headers
+                if location.is_in_system_header():
+                    continue
+                stack.extend(cursor.get_children())
+                kind = cursor.kind
+                if not self._cursor_kind_filter(int(kind.value)):
+                    continue
+                if kind == CursorKind.INCLUSION_DIRECTIVE:
+                    included_file = cursor.get_included_file()
+                    if included_file:
+                        self._create_code_dep(cursor, dst_file=included_file.name)
                     else:
                         logger.warn(
                             "Could not get include file for CodeNode {0}".format(
                                 CodeNode(cursor)
                             )
                         )
-                elif self._cursor_filter(cursor):
-                    # add dependencies
-                    self._create_code_dep(cursor)
-        except AssertionError as error:
-            # Output expected AssertionErrors.
-            logger.error("AssertionError: {}".format(error))
-        except Exception as exception:
-            # Output unexpected Exceptions.
-            logger.error(exception)
+                else:
+                    # ignore system header references and references within
+                    # the same file
+                    referenced = cursor.referenced
+                    if referenced is None:
+                        continue
+                    ref_location = referenced.location
+                    if (
+                        not ref_location.is_in_system_header()
+                        and ref_location.file
+                        and location.file.name != ref_location.file.name
+                    ):
+                        # add dependencies
+                        self._create_code_dep(cursor)
+            except AssertionError as error:
+                # Output expected AssertionErrors.
+                logger.error("AssertionError: {}".format(error))
+            except Exception as exception:
+                # Output unexpected Exceptions.
+                logger.error(exception)
 
     def _code_dump(self, cursor: Cursor, depth: int = 0):
         if self._cursor_skip(cursor):
@@ -182,14 +249,11 @@ class TUParser:
                 fail = True
         return fail
 
-    # def parse(self, clang_index: Index, total_comp_cmds: int, index: int, comp_cmd: List[str], code_dump: bool):
-    def parse(
-        self, total_comp_cmds: int, index: int, comp_cmd: CompCmd, code_dump: bool
-    ):
-        print(f"Parsing source file [{index+1}/{total_comp_cmds}]: {comp_cmd.filename}")
-        tu = Index.create().parse(
-            None, comp_cmd.cmd, options=TranslationUnit.PARSE_NONE
-        )
+    def parse(self, comp_cmd: CompCmd, code_dump: bool):
+        print(f"Parsing source file: {comp_cmd.filename}")
+        # reuse the per-worker Index, creating one per file is expensive
+        clang_index = _INDEX if _INDEX is not None else Index.create()
+        tu = clang_index.parse(None, comp_cmd.cmd, options=TranslationUnit.PARSE_NONE)
         if not tu:
             sys.exit("Error parsing file: ", comp_cmd.filename)
         if self._print_diagnostics(tu.diagnostics):
@@ -203,15 +267,58 @@ class TUParser:
         return self.deps
 
 
-# def handle_comp_cmd(tu_parser: TUParser, clang_index: Index, total_comp_cmds: int, index: int, comp_cmd: List[str], code_dump: bool):
-def handle_comp_cmd(
-    tu_parser: TUParser,
-    total_comp_cmds: int,
-    index: int,
-    comp_cmd: CompCmd,
-    code_dump: bool,
-):
-    return tu_parser.parse(total_comp_cmds, index, comp_cmd, code_dump)
+# bump whenever the pickled CodeDep/CodeRef/CodeNode layout changes, so
+# blobs written by an older layout can never be loaded
+_CACHE_SCHEMA = b"codedep-v2"
+
+# per-worker state, set up once by _init_worker so that the libclang Index
+# and the FSData are not recreated/re-pickled for every translation unit
+_INDEX = None
+_FS_DATA = None
+_FS_DIGEST = b""
+_CODE_DUMP = False
+
+
+def _init_worker(fs_data_bytes: bytes, fs_digest: bytes, code_dump: bool):
+    global _INDEX, _FS_DATA, _FS_DIGEST, _CODE_DUMP
+    _INDEX = Index.create()
+    _FS_DATA = pickle.loads(fs_data_bytes)
+    _FS_DIGEST = fs_digest
+    _CODE_DUMP = code_dump
+
+
+def _comp_cmd_cache_key(comp_cmd: CompCmd):
+    """
+    Cache key for a compile command, invalidated by the mtime of the main
+    source file, the filesystem scan the fs_ids were resolved against and
+    the pickle schema (include-level dependency tracking is a possible
+    follow-on)
+    """
+    try:
+        stat = os.stat(comp_cmd.filename)
+    except OSError:
+        return None
+    return cache.make_key(
+        _CACHE_SCHEMA,
+        _FS_DIGEST,
+        comp_cmd.filename.encode(),
+        "\0".join(comp_cmd.cmd).encode(),
+        str(stat.st_mtime_ns).encode(),
+    )
+
+
+def handle_comp_cmd(comp_cmd: CompCmd):
+    # code dumps go to stdout, there is nothing worth caching for them
+    key = None if _CODE_DUMP else _comp_cmd_cache_key(comp_cmd)
+    if key is not None:
+        blob = cache.get(key)
+        if blob is not None:
+            logger.debug(f"Cache hit for {comp_cmd.filename}")
+            return pickle.loads(blob)
+    deps = TUParser(_FS_DATA).parse(comp_cmd, _CODE_DUMP)
+    if key is not None:
+        cache.put(key, pickle.dumps(deps))
+    return deps
 
 
 class CodeParser:
@@ -229,38 +336,46 @@ class CodeParser:
             f"Creating compilation database from directory {compdb_file} using {num_cores} cores"
         )
         compdb = CompilationDatabase.fromDirectory(compdb_file)
-        total_comp_cmds = len(compdb.getAllCompileCommands())
-
-        # clang_index = Index.create()
-        custom_args = [
-            "-ferror-limit=0",
-            "-isystem",
-            "/Library/Developer/CommandLineTools/usr/lib/clang/11.0.0/include",
-            "-isystem",
-            "/Library/Developer/CommandLineTools/usr/include/c++/v1",
-            "-isystem",
-            "/Library/Developer/CommandLineTools/SDKs/MacOSX10.15.sdk/usr/include",
-            "-isystem",
-            "/opt/llvm/lib/clang/9.0.1/include",
-        ]
 
         comp_cmds = []
-        # get all the compile commands into basic list of list of strings
+        # get all the compile commands into basic picklable CompCmds
         for comp_cmd in compdb.getAllCompileCommands():
-            comp_args = list(comp_cmd.arguments)
-            comp_args.extend(custom_args)
-            comp_cmds.append(CompCmd(filename=comp_cmd.filename, cmd=comp_args))
-
-        deps: List[CodeDep] = []
-
-        # nested_deps = Parallel(n_jobs=num_cores, prefer="threads")(
-        nested_deps = Parallel(n_jobs=num_cores)(
-            delayed(handle_comp_cmd)(
-                TUParser(self.fs_data), total_comp_cmds, index, comp_cmd, self.code_dump
+            comp_cmds.append(
+                CompCmd(
+                    filename=comp_cmd.filename,
+                    cmd=tuple(comp_cmd.arguments) + CUSTOM_ARGS,
+                )
             )
-            for index, comp_cmd in enumerate(comp_cmds)
-        )
 
-        # flatten the nested list of deps
-        deps = [dep for deps in nested_deps for dep in deps]
+        logger.debug(f"Parsing {len(comp_cmds)} translation units")
+
+        # pickle fs_data once, each worker unpickles it once in _init_worker
+        fs_data_bytes = pickle.dumps(self.fs_data)
+        # cached deps carry fs_ids that are only valid for this exact scan,
+        # adding or removing any file renumbers the rest, so fold the
+        # scanned paths into the cache key (same digest as PumlParser)
+        fs_digest = cache.make_key(
+            str(sorted(self.fs_data.file_index.keys())).encode()
+        ).encode()
+        # batch the commands relative to the workload so small TUs are not
+        # round-tripped one pickle at a time
+        chunksize = max(1, len(comp_cmds) // (num_cores * 4))
+        deps: List[CodeDep] = []
+        with ProcessPoolExecutor(
+            max_workers=num_cores,
+            initializer=_init_worker,
+            initargs=(fs_data_bytes, fs_digest, self.code_dump),
+        ) as executor:
+            # executor.map yields as results arrive, stream them into deps
+            # instead of holding the full nested list as well
+            for tu_deps in executor.map(
+                handle_comp_cmd, comp_cmds, chunksize=chunksize
+            ):
+                deps.extend(tu_deps)
+        # pickling across the process boundary breaks string sharing, so
+        # re-intern the node paths before they fan out into dep_dict
+        for dep in deps:
+            for ref in (dep.src, dep.dst):
+                if ref.code_node is not None:
+                    ref.code_node.file = _intern_path(ref.code_node.file)
         return deps
@@ -1,8 +1,10 @@
+import array
 import os
 
+import numpy
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
-from typing import Dict, List
-from numba import jitclass, typeof
+from typing import Dict, List, Tuple
 
 from .counter import Counter
 from .logging import log_with
@@ -26,6 +28,9 @@ class FSData:
     index: Dict[int, FSEntry] = field(default_factory=lambda: {})
     file_index: Dict[str, FSEntry] = field(default_factory=lambda: {})
     root: FSEntry = None
+    # CSR-style descendant lookup, desc_ptr[i]..desc_ptr[i+1] slices desc_idx
+    desc_ptr: numpy.ndarray = None
+    desc_idx: numpy.ndarray = None
 
     def _add_fs_entry(self, fs_entry: FSEntry, parent: FSEntry):
         self.index[fs_entry.id] = fs_entry
@@ -40,15 +45,50 @@ class FSData:
         self._add_fs_entry(fs_entry=fs_entry, parent=parent)
         return fs_entry
 
-    def get_desc_ids(self, id: int, desc: List[int]):
+    def get_desc_ids(self, id: int, desc: array.array):
         """
-        Given a Filesystem ID, return all the IDs of descendents
+        Given a Filesystem ID, append all the IDs of descendents to desc,
+        an array.array('i') that packs 4 bytes per ID instead of a boxed
+        PyObject and converts to numpy via frombuffer at zero copy cost
         """
         desc.append(id)
         fs = self.index[id]
         for entry in fs.children:
             self.get_desc_ids(entry.id, desc)
 
+    def build_descendants(self):
+        """
+        Precomputes the descendant IDs of every entry into two flat arrays,
+        desc_idx holds the descendant IDs of entry i (including i itself) in
+        the slice desc_ptr[i]..desc_ptr[i+1], so lookups become array slices
+        instead of recursive tree walks
+        """
+        num_entries = len(self.index)
+        desc_lists: Dict[int, List[int]] = {}
+        # iterative post-order walk so children are resolved before parents
+        stack = [(self.root, False)]
+        while stack:
+            fs, visited = stack.pop()
+            if visited:
+                ids = [fs.id]
+                for entry in fs.children:
+                    ids.extend(desc_lists[entry.id])
+                desc_lists[fs.id] = ids
+            else:
+                stack.append((fs, True))
+                for entry in fs.children:
+                    stack.append((entry, False))
+
+        self.desc_ptr = numpy.zeros(num_entries + 1, dtype=numpy.int32)
+        flat_idx = array.array("i")
+        for id in range(num_entries):
+            # an entry not reachable from root is still its own descendant,
+            # matching what get_desc_ids returns for it
+            ids = desc_lists.get(id, [id])
+            self.desc_ptr[id + 1] = self.desc_ptr[id] + len(ids)
+            flat_idx.extend(ids)
+        self.desc_idx = numpy.frombuffer(flat_idx, dtype=numpy.int32)
+
     def get_full_path_by_id(self, id: int):
         return self.index[id].full_path
 
@@ -56,10 +96,11 @@ class FSData:
         """
     Returns the id of the fs, or None if no matching file is found
     """
-        if os.path.exists(path):
-            for fs in self.index.values():
-                if os.path.samefile(path, fs.full_path):
-                    return fs.id
+        # file_index is keyed by canonicalized paths, so one realpath is
+        # enough, no need to samefile-scan the whole index
+        fs = self.file_index.get(os.path.realpath(path))
+        if fs:
+            return fs.id
         return None
 
 
@@ -71,23 +112,69 @@ class FSScanner:
         self.file_extensions = (".c", ".cc", ".cpp", ".cxx", ".h", ".hpp")
         self.excludes = ["/build", ".git", "/tools/"]
 
-    def _entry_filter(self, entry: os.DirEntry):
-        return (
-            entry.is_dir() or entry.name.lower().endswith(self.file_extensions)
-        ) and not any(exclude in entry.path for exclude in self.excludes)
+    def _scan_directory(self, dir_path: str):
+        """
+        Lists a single directory, returning (dir_path, dirnames, filenames)
+        with the names sorted so that ID assignment stays deterministic
+        """
+        dirnames: List[str] = []
+        filenames: List[str] = []
+        for entry in os.scandir(dir_path):
+            if any(exclude in entry.path for exclude in self.excludes):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                dirnames.append(entry.name)
+            elif entry.name.lower().endswith(self.file_extensions):
+                filenames.append(entry.name)
+        dirnames.sort()
+        filenames.sort()
+        return dir_path, dirnames, filenames
 
     def _walk_directory(self, cur_dir: str, parent: FSEntry = None):
-        for entry in os.scandir(cur_dir):
-            if self._entry_filter(entry):
+        # the walk is purely IO-bound (scandir/stat release the GIL), so fan
+        # out one listing task per directory and collect the raw results
+        listings: Dict[str, Tuple[List[str], List[str]]] = {}
+        with ThreadPoolExecutor() as executor:
+            futures = [executor.submit(self._scan_directory, cur_dir)]
+            while futures:
+                next_futures = []
+                for future in futures:
+                    dir_path, dirnames, filenames = future.result()
+                    listings[dir_path] = (dirnames, filenames)
+                    next_futures.extend(
+                        executor.submit(
+                            self._scan_directory, os.path.join(dir_path, name)
+                        )
+                        for name in dirnames
+                    )
+                futures = next_futures
+
+        # assign IDs sequentially afterwards, in a fixed DFS order, so they
+        # do not depend on thread completion order
+        stack = [(cur_dir, parent)]
+        while stack:
+            dir_path, parent_entry = stack.pop()
+            dirnames, filenames = listings[dir_path]
+            for name in filenames:
+                self.fs_data.add_fs_entry(
+                    id=self.counter.get(),
+                    name=name,
+                    full_path=os.path.realpath(os.path.join(dir_path, name)),
+                    is_dir=False,
+                    parent=parent_entry,
+                )
+            child_dirs = []
+            for name in dirnames:
+                path = os.path.join(dir_path, name)
                 fs_entry = self.fs_data.add_fs_entry(
                     id=self.counter.get(),
-                    name=entry.name,
-                    full_path=os.path.realpath(entry.path),
-                    is_dir=entry.is_dir(),
-                    parent=parent,
+                    name=name,
+                    full_path=os.path.realpath(path),
+                    is_dir=True,
+                    parent=parent_entry,
                 )
-                if entry.is_dir():
-                    self._walk_directory(entry.path, fs_entry)
+                child_dirs.append((path, fs_entry))
+            stack.extend(reversed(child_dirs))
 
     @log_with(logger=logger, name="Scanning file system")
     def scan(self) -> FSData:
@@ -99,6 +186,8 @@ class FSScanner:
             is_dir=True,
             parent=None,
         )
-        # then walk the directory structure
-        self._walk_directory(self.base_dir)
+        # then walk the directory structure, rooted at the base_dir entry
+        self._walk_directory(self.base_dir, self.fs_data.root)
+        # precompute the descendant arrays once, while the tree is fresh
+        self.fs_data.build_descendants()
         return self.fs_data
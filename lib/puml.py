@@ -1,4 +1,4 @@
-import itertools, os, sys, typing
+import functools, itertools, os, pickle, sys, typing
 
 from collections import defaultdict
 from dataclasses import dataclass, field
@@ -8,6 +8,7 @@ from lark import Token
 from lark import Tree
 
 import lib.logging as log
+from . import cache
 from .counter import Counter
 from .logging import log_with
 from .fs import FSData, FSEntry
@@ -15,6 +16,19 @@ from .fs import FSData, FSEntry
 
 logger = log.get_custom_logger(__name__)
 
+GRAMMAR_FILE = "./lib/plantuml_grammar.ebnf"
+
+# bump whenever the pickled PumlData/PumlNode/PumlRule layout changes, so
+# blobs written by an older layout can never be loaded
+_CACHE_SCHEMA = b"pumldata-v1"
+
+
+@functools.lru_cache(maxsize=None)
+def _load_grammar() -> Lark:
+    # compiling the grammar costs hundreds of ms, do it once per process
+    with open(GRAMMAR_FILE) as grammar:
+        return Lark(grammar.read())
+
 
 @dataclass
 class PumlNode:
@@ -119,14 +133,13 @@ class PumlTree:
     def parse_puml(self, puml_file: str) -> defaultdict:
         tree = None
         root = None
-        with open("./lib/plantuml_grammar.ebnf") as grammar:
-            l = Lark(grammar.read())
-            with open(puml_file) as puml:
-                tree = l.parse(puml.read())
-                # set the root node
-                root = self._handle_node(tree)
-                for child in self._get_tree_children(tree):
-                    self._parse_tree(child, root)
+        l = _load_grammar()
+        with open(puml_file) as puml:
+            tree = l.parse(puml.read())
+            # set the root node
+            root = self._handle_node(tree)
+            for child in self._get_tree_children(tree):
+                self._parse_tree(child, root)
 
         if tree is None:
             sys.exit("Error!")
@@ -203,19 +216,29 @@ class PumlParser:
     1. Assign a FileSystem (FS) id to each PumlNode
     2. Create an index in puml_data
     """
-        self._handle_node(node, parent)
-        for child in node.children:
-            self._process_tree(child, node)
+        stack = [(node, parent)]
+        while stack:
+            node, parent = stack.pop()
+            self._handle_node(node, parent)
+            stack.extend((child, node) for child in node.children)
 
     def _get_desc_fs_ids(self, node: PumlNode):
         """
     Returns list of all FileSystem IDs of descendants
-    for a given PumlNode
+    for a given PumlNode, visiting each descendant exactly once
     """
-        fs_ids = node.fs_ids
-        for child in node.children:
-            fs_ids.extend(child.fs_ids)
-            fs_ids.extend(self._get_desc_fs_ids(child))
+        # _create_rules can ask for the same node across relationships,
+        # so cache the flattened result on the node
+        cached = getattr(node, "_desc_cache", None)
+        if cached is not None:
+            return cached
+        fs_ids: typing.List[int] = []
+        stack = [node]
+        while stack:
+            desc = stack.pop()
+            fs_ids.extend(desc.fs_ids or ())
+            stack.extend(desc.children)
+        node._desc_cache = fs_ids
         return fs_ids
 
     def _create_rules(self, puml_rels: typing.List[PumlRel]) -> None:
@@ -241,12 +264,36 @@ class PumlParser:
                         )
                     )
 
+    def _cache_key(self, puml_file: str) -> str:
+        """
+        Cache key for the processed PumlData, sensitive to the pickle
+        schema, the grammar, the PlantUML file and the scanned filesystem
+        the fs_ids refer to
+        """
+        with open(GRAMMAR_FILE, "rb") as grammar:
+            grammar_bytes = grammar.read()
+        with open(puml_file, "rb") as puml:
+            puml_bytes = puml.read()
+        return cache.make_key(
+            _CACHE_SCHEMA,
+            grammar_bytes,
+            puml_bytes,
+            str(sorted(self.fs_data.file_index.keys())).encode(),
+        )
+
     @log_with(logger=logger, name="Processing PlantUML File")
     def parse_puml(self, puml_file: str) -> defaultdict:
+        key = self._cache_key(puml_file)
+        blob = cache.get(key, subdir="puml")
+        if blob is not None:
+            logger.debug(f"PlantUML cache hit for {puml_file}")
+            self.puml_data = pickle.loads(blob)
+            return self.puml_data
         # get friendly version of the PlantUML AST and relationships
         root, puml_rels = PumlTree().parse_puml(puml_file)
         self.puml_data.root = root
         self._process_tree(root)
         self._create_rules(puml_rels)
         # self._create_fs_group_rules()
+        cache.put(key, pickle.dumps(self.puml_data), subdir="puml")
         return self.puml_data